@@ -1,68 +1,285 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import time
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 from supabase import create_client, Client
+from postgrest.types import ReturnMethod
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
+import html
+import os
+import logging
 
 # Supabase Configuration
 SUPABASE_URL = st.secrets["supabase"]["url"]
 SUPABASE_SERVICE_ROLE_KEY = st.secrets["supabase"]["key"]
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+
+@st.cache_resource
+def get_supabase() -> Client:
+    """Return the process-wide Supabase client, shared by every session and thread."""
+    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
 PRODUCTS_TABLE = "Products"
 FAVOURITES_TABLE = "Favourites"
-
-def supabase_get_records(table_name):
-    """Fetch all records from a Supabase table."""
+PRICE_HISTORY_TABLE = "Price History"
+
+# PostgREST caps each response (1000 rows by default), so larger tables are read in ranges
+SUPABASE_PAGE_SIZE = 1000
+
+# IN filters travel in the GET query string; at ~70 encoded characters per product URL,
+# 100 values keep each request well under common 8 KB URL limits
+SUPABASE_IN_BATCH_SIZE = 100
+
+# Unique key per table, appended to every paged query so tied rows keep one order across ranges
+PAGE_ORDER_KEYS = {
+    PRODUCTS_TABLE: ("uri",),
+    FAVOURITES_TABLE: ("URI", "User ID"),
+    PRICE_HISTORY_TABLE: ("URI", "Date"),
+}
+
+def _supabase_get_pages(table_name, order_by, desc, columns, filters):
+    """Read every row matching the filters, one range request at a time."""
+    records = []
+    while True:
+        query = get_supabase().table(table_name).select(columns)
+        for column, value in filters.items():
+            # A collection of values filters with IN, a single value with equality
+            query = query.in_(column, list(value)) if isinstance(value, (list, tuple, set)) else query.eq(column, value)
+        if order_by:
+            query = query.order(order_by, desc=desc)
+        for column in PAGE_ORDER_KEYS.get(table_name, ()):
+            query = query.order(column)
+        start = len(records)
+        response = query.range(start, start + SUPABASE_PAGE_SIZE - 1).execute()
+        # A short page may only mean the project's max-rows setting is below the page size,
+        # so only an empty page marks the end; the next range starts after the rows received
+        if not response.data:
+            return records
+        records.extend(response.data)  # Use the data attribute for successful responses
+
+def supabase_get_records(table_name, order_by=None, desc=False, columns="*", filters=None, raise_errors=False):
+    """Fetch all records from a Supabase table, optionally filtered by column equality and ordered by a column.
+
+    Failures return an empty list unless raise_errors is set, for callers that must not mistake them for no rows.
+    An IN filter is read in batches of SUPABASE_IN_BATCH_SIZE values, so order_by only holds within each batch.
+    """
+    filters = dict(filters or {})
     try:
-        response = supabase.table(table_name).select("*").execute()
-        return response.data  # Use the data attribute for successful responses
+        in_column = next((column for column, value in filters.items() if isinstance(value, (list, tuple, set))), None)
+        if in_column is None:
+            return _supabase_get_pages(table_name, order_by, desc, columns, filters)
+        values = list(filters[in_column])
+        records = []
+        for start in range(0, len(values), SUPABASE_IN_BATCH_SIZE):
+            batch_filters = {**filters, in_column: values[start:start + SUPABASE_IN_BATCH_SIZE]}
+            records.extend(_supabase_get_pages(table_name, order_by, desc, columns, batch_filters))
+        return records
     except Exception as e:
+        if raise_errors:
+            raise
         return []  # Remove st.error message
 
-def supabase_upsert_record(table_name, record):
-    """Insert or update a record in a Supabase table."""
-    try:
-        response = supabase.table(table_name).upsert(record).execute()
-        return response.data  # Use the data attribute for successful responses
-    except Exception as e:
-        return None  # Remove st.error message
+def supabase_upsert_records(table_name, records, chunk_size=500):
+    """Insert or update records in a Supabase table, one request per chunk."""
+    for start in range(0, len(records), chunk_size):
+        try:
+            # return=minimal: the written rows are not echoed back, halving the JSON on the wire
+            get_supabase().table(table_name).upsert(
+                records[start:start + chunk_size], returning=ReturnMethod.minimal
+            ).execute()
+        except Exception as e:
+            # One bad row fails its whole chunk; log it, since the caller carries on with the rest
+            logging.getLogger(__name__).exception(
+                "Upsert into %s failed for rows %d-%d", table_name, start, min(start + chunk_size, len(records)) - 1
+            )
 
-def supabase_delete_record(table_name, URI, user_id):
-    """Delete a record from a Supabase table."""
+def supabase_bulk_delete(table_name, uris, user_id):
+    """Delete several URIs for a user from a Supabase table in one request."""
     try:
-        query = supabase.table(table_name)
         response = (
-        supabase.table(table_name)
-        .delete()
-        .eq("URI", URI)        # First filter
-        .eq("User ID",user_id)  # Second filter
-        .execute()
+            get_supabase().table(table_name)
+            .delete()
+            .in_("URI", list(uris))
+            .eq("User ID", user_id)
+            .execute()
         )
         return response.data  # Use the data attribute for successful responses
     except Exception as e:
         return None  # Remove st.error message
 
+@st.cache_data(ttl=600, show_spinner=False)
 def load_products_from_supabase():
     """Load products from Supabase."""
-    records = supabase_get_records(PRODUCTS_TABLE)
-    return pd.DataFrame(records)
+    # Arrive in the default (weighted rating) order so the default sort is a no-op
+    # Only the columns the app reads, so the payload skips the unused raw_* fields
+    # Errors raise rather than return, so st.cache_data never stores a failed read for the whole TTL
+    records = supabase_get_records(
+        PRODUCTS_TABLE, order_by="weighted_rating", desc=True, columns=",".join(USED_COLS), raise_errors=True
+    )
+    if not records:
+        raise RuntimeError("Supabase returned no products")
+    return prepare_data(pd.DataFrame(records))
+
 
 # -------------------------------
 # Data Handling
 # -------------------------------
+PRODUCTS_PARQUET = "products.parquet"
+
+# Columns referenced by the filters, sorting and the product display loop
+USED_COLS = (
+    'title', 'uri', 'raw_ec_thumbnails', 'raw_ec_shortdesc', 'raw_lcbo_region_name',
+    'raw_country_of_manufacture', 'raw_lcbo_program', 'raw_ec_price', 'raw_ec_promo_price',
+    'raw_lcbo_unit_volume', 'raw_lcbo_alcohol_percent', 'raw_lcbo_sugar_gm_per_ltr',
+    'raw_sysconcepts', 'raw_lcbo_varietal_name', 'stores_inventory', 'raw_avg_reviews',
+    'raw_ec_rating', 'weighted_rating', 'raw_view_rank_yearly', 'raw_view_rank_monthly',
+    'raw_sell_rank_yearly', 'raw_sell_rank_monthly'
+)
+
+# Low-cardinality filter columns, compared as integer codes once categorical
+CATEGORY_COLS = ('raw_country_of_manufacture', 'raw_lcbo_region_name', 'raw_lcbo_varietal_name')
+
+# Numeric columns narrowed at load; 'N/A' placeholders become missing values
+NUMERIC_DTYPES = {
+    'raw_ec_rating': 'float32',
+    'weighted_rating': 'float32',
+    'raw_avg_reviews': 'Int32',
+    'stores_inventory': 'Int32',
+    'raw_online_inventory': 'Int32',
+    'raw_view_rank_yearly': 'Int32',
+    'raw_view_rank_monthly': 'Int32',
+    'raw_sell_rank_yearly': 'Int32',
+    'raw_sell_rank_monthly': 'Int32',
+}
+
+# CSV dtypes derived from the maps above, so prepare_data() finds the columns already typed.
+# Integer columns parse as float64, which tolerates fractional values; prepare_data() rounds them to Int32.
+CSV_DTYPES = {
+    **dict.fromkeys(CATEGORY_COLS, 'category'),
+    **{column: 'float64' if dtype == 'Int32' else dtype for column, dtype in NUMERIC_DTYPES.items()},
+}
+
 @st.cache_data
 def load_data(file_path):
-    df = pd.read_csv(file_path)
+    if file_path.endswith(".parquet"):
+        # Parquet is columnar and typed, so only the projected columns are decoded
+        df = pd.read_parquet(file_path, engine="pyarrow", columns=list(USED_COLS))
+    else:
+        # A callable usecols tolerates older CSVs that lack some of the used columns
+        df = pd.read_csv(file_path, usecols=lambda column: column in USED_COLS, dtype=CSV_DTYPES, engine='c')
+    return prepare_data(df)
+
+def save_products_parquet(df_products):
+    """Write a typed, columnar copy of the catalog for load_catalog() to fall back on."""
+    object_cols = df_products.select_dtypes(include="object").columns
+    # Written aside and swapped in, so a concurrent cold load never reads a partial file
+    tmp_path = f"{PRODUCTS_PARQUET}.tmp"
+    df_products.astype({c: "string" for c in object_cols}).to_parquet(
+        tmp_path, engine="pyarrow", compression="zstd"
+    )
+    os.replace(tmp_path, PRODUCTS_PARQUET)
+    # Only the file-backed loader is stale now; leave other caches intact
+    load_data.clear()
+
+def load_catalog():
+    """Load the product catalog for display, stopping the run with an error if it is unavailable."""
+    try:
+        return load_products_from_supabase()
+    except Exception as e:
+        pass
+    # Cold-start fallback: the copy saved by the last refresh, while Supabase is unreachable
+    if os.path.exists(PRODUCTS_PARQUET):
+        try:
+            data = load_data(PRODUCTS_PARQUET)
+            st.warning("Showing the last saved catalog; live products could not be loaded.")
+            return data
+        except Exception as e:
+            pass
+    st.error("Products could not be loaded right now. Please try again shortly.")
+    st.stop()
+
+# Columns read by the product display loop in main()
+DISPLAY_COLS = (
+    'title', 'uri', 'raw_country_of_manufacture', 'raw_lcbo_region_name', 'raw_lcbo_varietal_name',
+    'raw_ec_price', 'raw_ec_promo_price', 'raw_ec_rating', 'raw_avg_reviews', 'raw_ec_thumbnails',
+    'raw_lcbo_program', 'raw_lcbo_unit_volume', 'raw_ec_shortdesc', 'stores_inventory',
+    'raw_sell_rank_monthly', 'raw_view_rank_monthly', 'raw_sell_rank_yearly', 'raw_view_rank_yearly',
+    'raw_lcbo_alcohol_percent', 'raw_lcbo_sugar_gm_per_ltr', '_thumb_2048', '_thumb_1280',
+    '_has_image', '_is_vintages', '_price_html', '_rating_md'
+)
+
+# Matches the quoted 'Vintages' entry in the program list, not e.g. 'Vintages Essentials'
+_VINTAGES_RE = re.compile(r"['\"]Vintages['\"]")
+
+def prepare_data(df):
+    """Apply load-time dtypes so the per-rerun filters stay cheap."""
+    df = df.copy()
+    # Stamped per load so caches keyed on data_fingerprint() drop results from older data
+    df.attrs['version'] = time.time_ns()
+    for column, dtype in NUMERIC_DTYPES.items():
+        if column in df:
+            values = pd.to_numeric(df[column], errors='coerce')
+            if dtype == 'Int32':
+                # The nullable-int cast rejects fractional values such as 4.5 instead of truncating them
+                values = values.round()
+            df[column] = values.astype(dtype)
+    for column in CATEGORY_COLS:
+        if column in df:
+            df[column] = df[column].astype('category')
+    if 'title' in df:
+        # Arrow-backed so the literal search runs pyarrow's substring kernel instead of a per-title Python loop
+        df['_title_lc'] = df['title'].fillna('').astype(str).str.lower().astype('string[pyarrow]')
+    if 'raw_lcbo_program' in df:
+        # Flag Vintages once here rather than regex-scanning on every rerun
+        df['_is_vintages'] = df['raw_lcbo_program'].fillna('').astype(str).str.contains(_VINTAGES_RE)
+    if 'raw_ec_thumbnails' in df:
+        df['_has_image'] = df['raw_ec_thumbnails'].notna() & (df['raw_ec_thumbnails'] != 'N/A')
+        # Enlarged/detail image URLs only depend on the catalog, so derive them once
+        df['_thumb_2048'] = df['raw_ec_thumbnails'].map(lambda url: transform_image_url(url, "2048.2048.png"))
+        df['_thumb_1280'] = df['raw_ec_thumbnails'].map(lambda url: transform_image_url(url, "1280.1280.png"))
+    if 'raw_sysconcepts' in df:
+        # Lowercased once so the food-pairing filter is a single vectorized match
+        df['_sysconcepts_lc'] = df['raw_sysconcepts'].fillna('').astype(str).str.lower()
+    if 'raw_ec_price' in df and 'raw_ec_promo_price' in df:
+        # Card price markup in one vectorized pass rather than an f-string per card per rerun
+        regular = "$" + display_strings(df['raw_ec_price'])
+        promo = display_strings(df['raw_ec_promo_price'])
+        df['_price_html'] = np.where(
+            (promo != 'N/A').to_numpy(),
+            f'<div style="font-size: 16px;"><strong>Price:</strong> {_SALE_SVG}\n<strong>$' + promo
+            + '</strong> <span style="text-decoration: line-through; color: gray;">' + regular + '</span></div>',
+            '<div style="font-size: 16px;"><strong>Price:</strong> ' + regular + '</div>',
+        )
+    if 'raw_ec_rating' in df and 'raw_avg_reviews' in df:
+        df['_rating_md'] = (
+            "**Rating:** " + display_strings(df['raw_ec_rating'])
+            + " | **Reviews:** " + display_strings(df['raw_avg_reviews'])
+        )
     return df
 
+def display_values(frame):
+    """Return the frame as display-ready object columns, with 'N/A' for missing values."""
+    float32_cols = frame.select_dtypes('float32').columns
+    if len(float32_cols):
+        # Widen and round so e.g. 3.3 doesn't print as 3.299999952316284
+        frame = frame.astype(dict.fromkeys(float32_cols, 'float64'))
+        frame[float32_cols] = frame[float32_cols].round(2)
+    return frame.astype(object).fillna('N/A')
+
+def display_strings(series):
+    """Format a column for display, with 'N/A' for missing values."""
+    return display_values(series.to_frame()).iloc[:, 0].astype(str)
+
+@st.cache_data(show_spinner=False)
 def load_food_items():
     try:
         food_items = pd.read_csv('food_items.csv')
@@ -70,6 +287,18 @@ def load_food_items():
     except Exception as e:
         return pd.DataFrame(columns=['Category', 'FoodItem'])  # Remove st.error message
 
+@st.cache_data(show_spinner=False)
+def food_category_options():
+    """Sidebar options for the "Food Category" filter, built once rather than on every rerun."""
+    return ['All Dishes'] + column_options(load_food_items()['Category'])
+
+@st.cache_data(show_spinner=False)
+def food_category_pattern(category):
+    """One regex alternation over a category's lowercased food items, matched against `_sysconcepts_lc`."""
+    food_items = load_food_items()
+    selected_items = food_items.loc[food_items['Category'] == category, 'FoodItem'].str.lower()
+    return "|".join(map(re.escape, selected_items))
+
 def sort_data(data, column):
     sorted_data = data.sort_values(by=column, ascending=False)
     return sorted_data
@@ -77,32 +306,64 @@ def sort_data(data, column):
 # -------------------------------
 # Filter functions
 # -------------------------------
+# Sidebar filter columns and their "no filter" option
+FILTER_OPTION_COLUMNS = {
+    'raw_country_of_manufacture': 'All Countries',
+    'raw_lcbo_region_name': 'All Regions',
+    'raw_lcbo_varietal_name': 'All Varietals',
+}
+
+def data_fingerprint(data):
+    """Cheap identity for a products DataFrame, used as a cache key."""
+    return (len(data), data.attrs.get('version'))
+
+def column_options(series):
+    """Sorted distinct values of a column; categoricals already hold them as their categories."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.categories.tolist()
+    return sorted(series.dropna().unique().tolist())
+
+# Keyed per data version, so only the few most recent catalogs need to be kept
+@st.cache_data(max_entries=4)
+def _filter_options(fingerprint, _data):
+    """Build the sorted sidebar options once per dataset (`_data` is not hashed)."""
+    return {
+        column: [all_label] + column_options(_data[column])
+        for column, all_label in FILTER_OPTION_COLUMNS.items()
+    }
+
 def search_data(data, search_text):
     if search_text:
-        data = data[data['title'].str.contains(search_text, case=False, na=False)]
+        # Literal match against the pre-lowercased titles skips the IGNORECASE regex path
+        data = data[data['_title_lc'].str.contains(search_text.lower(), regex=False, na=False)]
     return data
 
+# Sort option -> (column, ascending)
+_SORT_KEYS = {
+    '# of reviews': ('raw_avg_reviews', False),
+    'Rating': ('raw_ec_rating', False),
+    'Top Viewed - Year': ('raw_view_rank_yearly', True),
+    'Top Viewed - Month': ('raw_view_rank_monthly', True),
+    'Top Seller - Year': ('raw_sell_rank_yearly', True),
+    'Top Seller - Month': ('raw_sell_rank_monthly', True),
+}
+
+def sort_column(sort_by):
+    """Map a sort option to its (column, ascending) pair; IMDb-style weighted rating is the default."""
+    return _SORT_KEYS.get(sort_by, ('weighted_rating', False))
+
 def sort_data_filter(data, sort_by):
     """Sort data based on the selected criteria, with IMDb-style weighted rating as the default."""
-    if sort_by == '# of reviews':
-        data = data.sort_values(by='raw_avg_reviews', ascending=False)
-    elif sort_by == 'Rating':
-        data = data.sort_values(by='raw_ec_rating', ascending=False)
-    elif sort_by == 'Top Viewed - Year':
-        data = data.sort_values(by='raw_view_rank_yearly', ascending=True)
-    elif sort_by == 'Top Viewed - Month':
-        data = data.sort_values(by='raw_view_rank_monthly', ascending=True)
-    elif sort_by == 'Top Seller - Year':
-        data = data.sort_values(by='raw_sell_rank_yearly', ascending=True)
-    elif sort_by == 'Top Seller - Month':
-        data = data.sort_values(by='raw_sell_rank_monthly', ascending=True)
-    else:
-        # Default to IMDb-style weighted rating
-        data = data.sort_values(by='weighted_rating', ascending=False)
-    return data
-
-def filter_and_sort_data(data, sort_by, **filters):
-    """Apply filters and ensure IMDb-style sorting is always the default."""
+    column, ascending = sort_column(sort_by)
+    # Sort columns are made numeric once in prepare_data(), with 'N/A' placeholders as missing values
+    key = data[column]
+    # Catalogs are stored pre-sorted by weighted rating, so the default order is often already in place
+    if (key.is_monotonic_increasing if ascending else key.is_monotonic_decreasing):
+        return data
+    return data.sort_values(by=column, ascending=ascending, na_position='last')
+
+def filter_and_search_data(data, **filters):
+    """Apply the sidebar filters and the title search, without sorting."""
     # Extract search_text and store from filters and handle them separately
     search_text = filters.pop('search_text', '')
     filters.pop('store', None)  # Remove 'store' key if it exists
@@ -111,61 +372,90 @@ def filter_and_sort_data(data, sort_by, **filters):
     data = filter_data(data, **filters)
 
     # Apply search filter
-    data = search_data(data, search_text)
+    return search_data(data, search_text)
+
+def filter_and_sort_data(data, sort_by, **filters):
+    """Apply filters and ensure IMDb-style sorting is always the default."""
+    data = filter_and_search_data(data, **filters)
 
     # Sort data
     data = sort_data_filter(data, sort_by)
     return data
 
-def filter_data(data, country='All Countries', region='All Regions', varietal='All Varietals', exclude_usa=False, in_stock=False, only_vintages=False):
+@st.cache_data(max_entries=32)
+def _filtered_sorted_data(fingerprint, filter_items, sort_by, _data):
+    """Filter, search and sort once per dataset and filter state, so paging only slices."""
+    return filter_and_sort_data(_data, sort_by, **dict(filter_items))
+
+def filter_data(data, country='All Countries', region='All Regions', varietal='All Varietals', exclude_usa=False, in_stock=False, only_vintages=False, only_sale_items=False, favourites=None, food_pattern=None):
+    # AND every predicate into one mask and slice once, instead of copying the frame per filter
+    mask = np.ones(len(data), dtype=bool)
     if country != 'All Countries':
-        data = data[data['raw_country_of_manufacture'] == country]
+        mask &= data['raw_country_of_manufacture'].values == country
     if region != 'All Regions':
-        data = data[data['raw_lcbo_region_name'] == region]
+        mask &= data['raw_lcbo_region_name'].values == region
     if varietal != 'All Varietals':
-        data = data[data['raw_lcbo_varietal_name'] == varietal]
+        mask &= data['raw_lcbo_varietal_name'].values == varietal
     if in_stock:
-        # Ensure 'stores_inventory' is numeric
-        data['stores_inventory'] = pd.to_numeric(data['stores_inventory'], errors='coerce')
-        data = data[data['stores_inventory'] > 0]
+        # 'stores_inventory' is made numeric once in prepare_data()
+        mask &= (data['stores_inventory'] > 0).to_numpy(dtype=bool, na_value=False)
     if only_vintages:
-        data = data[data['raw_lcbo_program'].str.contains(r"['\"]Vintages['\"]", regex=True, na=False)]
+        mask &= data['_is_vintages'].to_numpy()
     if exclude_usa:
-        data = data[data['raw_country_of_manufacture'] != 'United States']
-    return data
+        mask &= data['raw_country_of_manufacture'].values != 'United States'
+    if only_sale_items:
+        promo_price = data['raw_ec_promo_price']
+        mask &= (promo_price.notna() & (promo_price != 'N/A')).to_numpy(dtype=bool, na_value=False)
+    if favourites is not None:
+        mask &= data['uri'].isin(favourites).to_numpy()
+    if food_pattern:
+        mask &= data['_sysconcepts_lc'].str.contains(food_pattern, regex=True, na=False).to_numpy(dtype=bool)
+    # With no active filter (the default view) keep the frame as is instead of copying every row
+    if mask.all():
+        return data
+    return data[mask]
 
 # -------------------------------
 # Favourites Handling
 # -------------------------------
+@st.cache_data(ttl=300, show_spinner=False)
 def load_favourites():
-    """Load favourites from Supabase."""
-    records = supabase_get_records(FAVOURITES_TABLE)
-    return [record["URI"] for record in records if record.get("User ID") == "admin"]
+    """Load favourites from Supabase as a set of URIs."""
+    # Filter on the server so only this user's rows are sent; an index on ("User ID", "URI") keeps it a lookup
+    # Errors raise rather than return, so a failed read isn't cached as an empty set
+    records = supabase_get_records(FAVOURITES_TABLE, columns="URI", filters={"User ID": "admin"}, raise_errors=True)
+    return {record["URI"] for record in records}
+
+def reload_session_favourites():
+    """Refresh session favourites from Supabase, leaving them unset if the read fails so the next run retries."""
+    load_favourites.clear()
+    try:
+        st.session_state.favourites = load_favourites()
+    except Exception as e:
+        st.session_state.pop("favourites", None)
+        st.warning("Favourites could not be loaded right now.")
 
 
 def save_favourites(favourites):
     """Save favourites to Supabase."""
     today_str = datetime.now().strftime("%Y-%m-%d")
-    for uri in favourites:
-        supabase_upsert_record(FAVOURITES_TABLE, {"URI": uri, "Date": today_str, "User ID": "admin"})
+    records = [{"URI": uri, "Date": today_str, "User ID": "admin"} for uri in favourites]
+    supabase_upsert_records(FAVOURITES_TABLE, records)
     # Reload favourites to ensure button state is updated
-    st.session_state.favourites = load_favourites()
+    reload_session_favourites()
     st.success("Favourites saved successfully!")
-    st.rerun()
 
 def delete_favourites(favourites):
     """Remove favourites in Supabase."""
-    for uri in favourites:
-        supabase_delete_record(FAVOURITES_TABLE, uri, "admin")
+    supabase_bulk_delete(FAVOURITES_TABLE, favourites, "admin")
     # Reload favourites to ensure button state is updated
-    st.session_state.favourites = load_favourites()
+    reload_session_favourites()
     st.success("Favourites removed successfully!")
-    st.rerun()
 
 def toggle_favourite(wine_id):
     """Toggle the favourite status of a wine."""
-    # Load favourites filtered by the current user
-    favourites = load_favourites()
+    # Session favourites are reloaded after every save/delete, so no extra fetch is needed here
+    favourites = st.session_state.favourites
     if wine_id in favourites:
         # Remove from favourites by filtering the table using the URI column
         delete_favourites([wine_id])
@@ -174,11 +464,14 @@ def toggle_favourite(wine_id):
         # Add to favourites
         save_favourites([wine_id])
         st.success(f"Added wine with URI '{wine_id}' to favourites.")  # Keep this message
-    st.rerun()  # Ensure the UI updates after toggling
+    st.rerun()  # Single rerun so the UI reflects the toggle
 
 # -------------------------------
 # Helper: Transform Image URL
 # -------------------------------
+# Finds a pattern like "digits.digits.ext" at the end of an image URL
+_SIZE_RE = re.compile(r"\d+\.\d+\.(?:png|PNG)$")
+
 def transform_image_url(url, new_size):
     """
     Replace the ending pattern (e.g., '319.319.PNG') in the URL with the new size string.
@@ -186,24 +479,40 @@ def transform_image_url(url, new_size):
     """
     if not isinstance(url, str):
         return url
-    # This regex finds a pattern like "digits.digits.ext" at the end of the URL
-    return re.sub(r"\d+\.\d+\.(png|PNG)$", new_size, url)
+    return _SIZE_RE.sub(new_size, url)
 
 # -------------------------------
 # Refresh function
 # -------------------------------
 def get_favourites_with_lowest_price():
     """Check if favourites are at their lowest price."""
-    favourites = supabase_get_records(FAVOURITES_TABLE)
-    products = supabase_get_records(PRODUCTS_TABLE)
-    price_history = supabase_get_records("Price History") 
+    # Fetch only the favourite URIs, then just those products and their price history
+    favourites = supabase_get_records(FAVOURITES_TABLE, columns="URI", filters={"User ID": "admin"})
+    uris = list({fav["URI"] for fav in favourites})
+    if not uris:
+        return []
+    # The two lookups only depend on the URIs, so issue them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        products = executor.submit(
+            supabase_get_records, PRODUCTS_TABLE,
+            columns="uri,title,raw_ec_price,raw_ec_promo_price", filters={"uri": uris},
+        )
+        price_history = executor.submit(
+            supabase_get_records, PRICE_HISTORY_TABLE, columns="URI,Price", filters={"URI": uris}
+        )
+        products, price_history = products.result(), price_history.result()
 
-    lowest_price_items = []
-    for fav in favourites:
-        uri = fav["URI"]
+    products_by_uri = {product["uri"]: product for product in products}
+    lowest_prices = {}
+    for entry in price_history:
+        uri = entry["URI"]
+        if uri not in lowest_prices or entry["Price"] < lowest_prices[uri]:
+            lowest_prices[uri] = entry["Price"]
 
+    lowest_price_items = []
+    for uri in uris:
         # Look up the current price in the Products table
-        product = next((p for p in products if p["uri"] == uri), None)
+        product = products_by_uri.get(uri)
         if not product:
             continue
         current_price = product.get("raw_ec_promo_price", "N/A")
@@ -213,10 +522,9 @@ def get_favourites_with_lowest_price():
             continue
 
         # Look up the lowest price in the Price History table
-        history = [entry for entry in price_history if entry["URI"] == uri]
-        if not history:
+        lowest_price = lowest_prices.get(uri)
+        if lowest_price is None:
             continue
-        lowest_price = min(entry["Price"] for entry in history)
 
         # Compare prices
         if float(current_price) == float(lowest_price):
@@ -228,6 +536,11 @@ def get_favourites_with_lowest_price():
             })
     return lowest_price_items
 
+LOWEST_PRICE_EMAIL_HEADER = (
+    "<h3>Favourites at Their Lowest Price</h3><table border='1'>"
+    "<tr><th>Title</th><th>URI</th><th>Current Price</th><th>Lowest Price</th></tr>"
+)
+
 def send_email_with_lowest_prices(items):
     """Send an email with the list of favourite items at their lowest price using Postmark SMTP."""
     if not items:
@@ -250,10 +563,13 @@ def send_email_with_lowest_prices(items):
     message["To"] = receiver_email
     message["Subject"] = subject
 
-    html_content = "<h3>Favourites at Their Lowest Price</h3><table border='1'><tr><th>Title</th><th>URI</th><th>Current Price</th><th>Lowest Price</th></tr>"
-    for item in items:
-        html_content += f"<tr><td>{item['Title']}</td><td><a href='{item['URI']}'>{item['URI']}</a></td><td>{item['Current Price']}</td><td>{item['Lowest Price']}</td></tr>"
-    html_content += "</table>"
+    rows = [
+        f"<tr><td>{html.escape(str(item['Title']))}</td>"
+        f"<td><a href='{html.escape(item['URI'])}'>{html.escape(item['URI'])}</a></td>"
+        f"<td>{item['Current Price']}</td><td>{item['Lowest Price']}</td></tr>"
+        for item in items
+    ]
+    html_content = LOWEST_PRICE_EMAIL_HEADER + "".join(rows) + "</table>"
 
     message.attach(MIMEText(html_content, "html"))
 
@@ -273,14 +589,80 @@ def background_update(df_products, today_str):
     send_email_with_lowest_prices(lowest_price_items)
 
 
+@st.cache_resource
+def background_executor():
+    """Return the process-wide single-worker executor for post-refresh Supabase writes and emails."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="refresh-background")
+
+@st.cache_resource
+def background_jobs():
+    """Return the lock and list of futures queued by the latest refresh, shared by every session."""
+    return threading.Lock(), []
+
+def queue_background_jobs(*jobs):
+    """Queue (function, *args) jobs on the background worker, cancelling any an earlier refresh left unstarted."""
+    executor = background_executor()
+    lock, pending = background_jobs()
+    with lock:
+        # Unstarted jobs hold a full product frame and would only write data this refresh overwrites
+        for future in pending:
+            future.cancel()
+        pending[:] = [executor.submit(function, *args) for function, *args in jobs]
+        for future in pending:
+            future.add_done_callback(log_background_error)
+
+def log_background_error(future):
+    """Done-callback that logs a background task's exception, which the executor would otherwise keep silently."""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logging.getLogger(__name__).error("Background task failed", exc_info=error)
+
+# Output column -> (key in a Coveo result's 'raw' dict, default); title and uri are top-level keys
+FIELD_MAP = {
+    'raw_ec_thumbnails': ('ec_thumbnails', 'N/A'),
+    'raw_ec_shortdesc': ('ec_shortdesc', 'N/A'),
+    'raw_lcbo_tastingnotes': ('lcbo_tastingnotes', 'N/A'),
+    'raw_lcbo_region_name': ('lcbo_region_name', 'N/A'),
+    'raw_country_of_manufacture': ('country_of_manufacture', 'N/A'),
+    'raw_lcbo_program': ('lcbo_program', 'N/A'),
+    'raw_created_at': ('created_at', 'N/A'),
+    'raw_is_buyable': ('is_buyable', 'N/A'),
+    'raw_ec_price': ('ec_price', 'N/A'),
+    'raw_ec_final_price': ('ec_final_price', 'N/A'),
+    'raw_ec_promo_price': ('ec_promo_price', 'N/A'),
+    'raw_lcbo_unit_volume': ('lcbo_unit_volume', 'N/A'),
+    'raw_lcbo_alcohol_percent': ('lcbo_alcohol_percent', 'N/A'),
+    'raw_lcbo_sugar_gm_per_ltr': ('lcbo_sugar_gm_per_ltr', 'N/A'),
+    'raw_lcbo_bottles_per_pack': ('lcbo_bottles_per_pack', 'N/A'),
+    'raw_sysconcepts': ('sysconcepts', 'N/A'),
+    'raw_ec_category': ('ec_category', 'N/A'),
+    'raw_ec_category_filter': ('ec_category_filter', 'N/A'),
+    'raw_lcbo_varietal_name': ('lcbo_varietal_name', 'N/A'),
+    'raw_stores_stock': ('stores_stock', 'N/A'),
+    'raw_stores_stock_combined': ('stores_stock_combined', 'N/A'),
+    'raw_stores_low_stock_combined': ('stores_low_stock_combined', 'N/A'),
+    'raw_stores_low_stock': ('stores_low_stock', 'N/A'),
+    'raw_out_of_stock': ('out_of_stock', 'N/A'),
+    'stores_inventory': ('stores_inventory', 0),
+    'raw_online_inventory': ('online_inventory', 0),
+    'raw_avg_reviews': ('avg_reviews', 0),
+    'raw_ec_rating': ('ec_rating', 0),
+    'raw_view_rank_yearly': ('view_rank_yearly', 'N/A'),
+    'raw_view_rank_monthly': ('view_rank_monthly', 'N/A'),
+    'raw_sell_rank_yearly': ('sell_rank_yearly', 'N/A'),
+    'raw_sell_rank_monthly': ('sell_rank_monthly', 'N/A'),
+}
+
+# Concurrent page requests to Coveo, and the minimum spacing between request starts (seconds)
+COVEO_MAX_WORKERS = 8
+COVEO_MIN_INTERVAL = 0.2
+
 def refresh_data(store_id=None):
     """Refresh data and update Supabase."""
     current_time = datetime.now()
     today_str = current_time.strftime("%Y-%m-%d")
-    # Check if today's data already exists in Supabase
-    records = supabase_get_records(PRODUCTS_TABLE)
-   # if any(record.get("Date") == today_str for record in records):
-    #    return load_products_from_supabase()
 
     url = "https://platform.cloud.coveo.com/rest/search/v2?organizationId=lcboproduction2kwygmc"
     headers = {
@@ -318,9 +700,31 @@ def refresh_data(store_id=None):
         }
         initial_payload.update(dictionaryFieldContext)
 
+    # One keep-alive connection pool shared by all page requests; throttling and
+    # transient server errors are retried with backoff rather than failing the page
+    session = requests.Session()
+    retry = Retry(
+        total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503), allowed_methods=None,
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=COVEO_MAX_WORKERS, max_retries=retry))
+    rate_lock = threading.Lock()
+    next_request_at = [time.monotonic()]
+
     def get_items(payload):
-        response = requests.post(url, headers=headers, json=payload)
-        return response.json()
+        # Space out request starts so concurrent pages stay polite to the API
+        with rate_lock:
+            now = time.monotonic()
+            wait = next_request_at[0] - now
+            next_request_at[0] = max(next_request_at[0], now) + COVEO_MIN_INTERVAL
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            response = session.post(url, headers=headers, json=payload, timeout=30)
+            return response.json()
+        except (requests.RequestException, ValueError):
+            # A page that still fails after retries (or times out) is reported by the 'results' check
+            return {}
 
     data = get_items(initial_payload)
     if 'results' in data:
@@ -328,133 +732,70 @@ def refresh_data(store_id=None):
         total_count = data['totalCount']
         st.info(f"Loaded {total_count} items.")  # Keep this message
         num_requests = (total_count // 500) + (1 if total_count % 500 != 0 else 0)
-        for i in range(1, num_requests):
-            payload = {
-                "q": "",
-                "tab": "clp-products-wine-red_wine",
-                "sort": "ec_rating descending",
-                "facets": [
-                    {
-                        "field": "ec_rating",
-                        "currentValues": [
-                            {
-                                "value": "4..5inc",
-                                "state": "selected"
-                            }
-                        ]
-                    }
-                ],
-                "numberOfResults": 500,
-                "firstResult": i * 500,
-                "aq": "@ec_visibility==(2,4) @cp_browsing_category_deny<>0 @ec_category==\"Products|Wine|Red Wine\" (@ec_rating==5..5 OR @ec_rating==4..4.9)"
-            }
-            if store_id:
-                payload.update(dictionaryFieldContext)
-            data = get_items(payload)
-            if 'results' in data:
-                all_items.extend(data['results'])
-            else:
-                st.error(f"Key 'results' not found in the response during pagination. Response: {data}")
-            time.sleep(1)  # Avoid hitting the server too frequently
-
-        
-        products = []
+        # Remaining pages only differ by offset; fetch them concurrently, in order
+        payloads = [{**initial_payload, "firstResult": i * 500} for i in range(1, num_requests)]
+        with ThreadPoolExecutor(max_workers=COVEO_MAX_WORKERS) as executor:
+            for data in executor.map(get_items, payloads):
+                if 'results' in data:
+                    all_items.extend(data['results'])
+                else:
+                    st.error(f"Key 'results' not found in the response during pagination. Response: {data}")
+
+        # Fill one list per column, then build the DataFrame in a single pass
+        columns = {'title': [], 'uri': [], **{name: [] for name in FIELD_MAP}}
         for product in all_items:
             raw_data = product['raw']
-            
-            product_info = {
-                'title': product.get('title', 'N/A'),
-                'uri': product.get('uri', 'N/A'),
-                'raw_ec_thumbnails': raw_data.get('ec_thumbnails', 'N/A'),
-                'raw_ec_shortdesc': raw_data.get('ec_shortdesc', 'N/A'),
-                'raw_lcbo_tastingnotes': raw_data.get('lcbo_tastingnotes', 'N/A'),
-                'raw_lcbo_region_name': raw_data.get('lcbo_region_name', 'N/A'),
-                'raw_country_of_manufacture': raw_data.get('country_of_manufacture', 'N/A'),
-                'raw_lcbo_program': raw_data.get('lcbo_program', 'N/A'),
-                'raw_created_at': raw_data.get('created_at', 'N/A'),
-                'raw_is_buyable': raw_data.get('is_buyable', 'N/A'),
-                'raw_ec_price': raw_data.get('ec_price', 'N/A'),
-                'raw_ec_final_price': raw_data.get('ec_final_price', 'N/A'),
-                'raw_ec_promo_price': raw_data.get('ec_promo_price', 'N/A'),
-                'raw_lcbo_unit_volume': raw_data.get('lcbo_unit_volume', 'N/A'),
-                'raw_lcbo_alcohol_percent': raw_data.get('lcbo_alcohol_percent', 'N/A'),
-                'raw_lcbo_sugar_gm_per_ltr': raw_data.get('lcbo_sugar_gm_per_ltr', 'N/A'),
-                'raw_lcbo_bottles_per_pack': raw_data.get('lcbo_bottles_per_pack', 'N/A'),
-                'raw_sysconcepts': raw_data.get('sysconcepts', 'N/A'),
-                'raw_ec_category': raw_data.get('ec_category', 'N/A'),
-                'raw_ec_category_filter': raw_data.get('ec_category_filter', 'N/A'),
-                'raw_lcbo_varietal_name': raw_data.get('lcbo_varietal_name', 'N/A'),
-                'raw_stores_stock': raw_data.get('stores_stock', 'N/A'),
-                'raw_stores_stock_combined': raw_data.get('stores_stock_combined', 'N/A'),
-                'raw_stores_low_stock_combined': raw_data.get('stores_low_stock_combined', 'N/A'),
-                'raw_stores_low_stock': raw_data.get('stores_low_stock', 'N/A'),
-                'raw_out_of_stock': raw_data.get('out_of_stock', 'N/A'),
-                'stores_inventory': raw_data.get('stores_inventory', 0),
-                'raw_online_inventory': raw_data.get('online_inventory', 0),
-                'raw_avg_reviews': raw_data.get('avg_reviews', 0),
-                'raw_ec_rating': raw_data.get('ec_rating', 0),
-                'weighted_rating': 0.0,  # Placeholder for weighted rating
-                'raw_view_rank_yearly': raw_data.get('view_rank_yearly', 'N/A'),
-                'raw_view_rank_monthly': raw_data.get('view_rank_monthly', 'N/A'),
-                'raw_sell_rank_yearly': raw_data.get('sell_rank_yearly', 'N/A'),
-                'raw_sell_rank_monthly': raw_data.get('sell_rank_monthly', 'N/A')
-            }
-            products.append(product_info)
+            columns['title'].append(product.get('title', 'N/A'))
+            columns['uri'].append(product.get('uri', 'N/A'))
+            for name, (key, default) in FIELD_MAP.items():
+                columns[name].append(raw_data.get(key, default))
 
         # Create a temporary DataFrame for immediate display
-        df_products = pd.DataFrame(products)
+        df_products = pd.DataFrame(columns)
         # Calculate mean rating for products with reviews
         valid_reviews = pd.to_numeric(df_products['raw_avg_reviews'], errors='coerce')
         valid_ratings = pd.to_numeric(df_products['raw_ec_rating'], errors='coerce')
         mean_rating = valid_ratings[valid_reviews > 0].mean()
         minimum_votes = 10  # Minimum number of votes required
         
-        def weighted_rating(R, v, m, C):
-            # Calculate IMDb-style weighted rating
-            return (v / (v + m)) * R + (m / (v + m)) * C
-
-        # Compute weighted rating using numeric conversion
-        df_products['weighted_rating'] = df_products.apply(
-            lambda x: weighted_rating(
-                float(x['raw_ec_rating']) if pd.notna(x['raw_ec_rating']) and x['raw_ec_rating'] != 'N/A' else 0,
-                float(x['raw_avg_reviews']) if pd.notna(x['raw_avg_reviews']) and x['raw_avg_reviews'] != 'N/A' else 0,
-                minimum_votes,
-                mean_rating if not pd.isna(mean_rating) else 0
-            ),
-            axis=1
-        )
-
+        # Compute IMDb-style weighted rating as one vectorized expression
+        R = valid_ratings.fillna(0).to_numpy()
+        v = valid_reviews.fillna(0).to_numpy()
+        m, C = minimum_votes, (mean_rating if not pd.isna(mean_rating) else 0.0)
+        denom = v + m
+        df_products['weighted_rating'] = (v / denom) * R + (m / denom) * C
+        # Store the catalog in the default display order
+        df_products = df_products.sort_values('weighted_rating', ascending=False, kind='stable').reset_index(drop=True)
 
         # Start background thread for updates
         def update_supabase():
             """Update the Products and Price History tables in Supabase."""
-            for _, product in df_products.iterrows():
-                product_data = product.to_dict()
-                product_data["Date"] = today_str  # Add today's date
-
-                # Update the Products table
-                supabase_upsert_record(PRODUCTS_TABLE, product_data)
-
-                # Determine the price to store in the Price History table
-                price = product_data.get("raw_ec_promo_price", "N/A")
-                if price == "N/A":
-                    price = product_data.get("raw_ec_price", "N/A")
-
-                # Update the Price History table if a valid price exists
-                if price != "N/A":
-                    price_history_data = {
-                        "URI": product_data.get("uri", "N/A"),
-                        "Title": product_data.get("title", "Unknown"),
-                        "Date": today_str,
-                        "Price": price
-                    }
-                    supabase_upsert_record("Price History", price_history_data)
-
-        threading.Thread(target=update_supabase, daemon=True).start()
-        threading.Thread(target=background_update(df_products, today_str), daemon=True).start()
+            # Update the Products table with today's date, in bulk
+            supabase_upsert_records(PRODUCTS_TABLE, df_products.assign(Date=today_str).to_dict(orient="records"))
+
+            # Use the promo price when there is one, and skip products without any price
+            promo_price = df_products["raw_ec_promo_price"]
+            price = promo_price.where(promo_price != "N/A", df_products["raw_ec_price"])
+            price_history = (
+                df_products[["uri", "title"]]
+                .rename(columns={"uri": "URI", "title": "Title"})
+                .assign(Date=today_str, Price=price)
+            )
+            price_history = price_history[price_history["Price"] != "N/A"]
+            supabase_upsert_records(PRICE_HISTORY_TABLE, price_history.to_dict(orient="records"))
+            # The cached product table is stale once the new rows are written
+            load_products_from_supabase.clear()
+
+        # Queued on one shared worker: the lowest-price check runs after today's prices are written,
+        # and only the latest refresh stays queued instead of stacking writers behind each other
+        queue_background_jobs(
+            (save_products_parquet, df_products),
+            (update_supabase,),
+            (background_update, df_products, today_str),
+        )
 
         st.success("Data loaded! Background updates are in progress.")  # Keep this message
-        return df_products
+        return prepare_data(df_products)
     else:
         return None  # Remove st.error message
 
@@ -475,10 +816,162 @@ def get_country_flag_url(country_name):
         st.error(f"Error loading country codes: {e}")
     return None
 
+@st.cache_data(max_entries=10000, show_spinner=False)
+def card_header_html(title, country_name):
+    """Return the markup for a product card heading, with the country flag when one is known."""
+    flag_url = get_country_flag_url(country_name) if country_name != 'N/A' else None
+    if not flag_url:
+        # Rendered with HTML enabled too, so the title is escaped here as well
+        return f"### {html.escape(str(title))}"
+    # Combine the title and flag in a single Markdown string
+    return f"""<h3 style="display: flex; align-items: center;">
+        {html.escape(str(title))}
+        <img src="{flag_url}" alt="{html.escape(str(country_name))}" style="margin-left: 10px; width: 30px; height: 20px;">
+    </h3>"""
+
+# (label, column) rows of the "Product Details" expander, in display order
+DETAIL_FIELDS = (
+    ('Title', 'title'),
+    ('URL', 'uri'),
+    ('Country', 'raw_country_of_manufacture'),
+    ('Region', 'raw_lcbo_region_name'),
+    ('Type', 'raw_lcbo_varietal_name'),
+    ('Size', 'raw_lcbo_unit_volume'),
+    ('Description', 'raw_ec_shortdesc'),
+    ('Price', 'raw_ec_price'),
+    ('Rating', 'raw_ec_rating'),
+    ('Reviews', 'raw_avg_reviews'),
+    ('Store Inventory', 'stores_inventory'),
+    ('Monthly Sold Rank', 'raw_sell_rank_monthly'),
+    ('Monthly View Rank', 'raw_view_rank_monthly'),
+    ('Yearly Sold Rank', 'raw_sell_rank_yearly'),
+    ('Yearly View Rank', 'raw_view_rank_yearly'),
+    ('Alcohol %', 'raw_lcbo_alcohol_percent'),
+    ('Sugar (p/ltr)', 'raw_lcbo_sugar_gm_per_ltr'),
+)
+
+# Sale icon markup, sent once per page as a <symbol> that each promo price references
+_SALE_SVG_SYMBOL = """<svg width="0" height="0" style="position: absolute" xmlns="http://www.w3.org/2000/svg">
+<symbol id="sale-icon" viewBox="0 0 455 455">
+<g id="SVGRepo_bgCarrier" stroke-width="0"></g>
+<g id="SVGRepo_tracerCarrier" stroke-linecap="round" stroke-linejoin="round"></g>
+<g id="SVGRepo_iconCarrier">
+    <g>
+        <polygon points="191.455,234.88 206.575,234.88 199.105,212.29"></polygon>
+        <path d="M0,113.06V341.94h455V113.06H0z M160.991,249.685c-1.35,2.49-3.136,4.5-5.355,6.03c-2.221,1.53-4.77,2.641-7.65,3.33 c-2.88,0.689-5.85,1.035-8.91,1.035c-2.34,0-4.741-0.18-7.2-0.54c-2.461-0.36-4.86-0.885-7.2-1.575 c-2.34-0.689-4.605-1.515-6.795-2.475c-2.191-0.959-4.216-2.07-6.075-3.33l6.48-12.87c0.239,0.301,1.02,0.87,2.34,1.71 c1.319,0.841,2.955,1.68,4.905,2.52c1.949,0.841,4.125,1.59,6.525,2.25c2.399,0.661,4.829,0.99,7.29,0.99 c5.22,0,7.83-1.589,7.83-4.77c0-1.199-0.391-2.189-1.17-2.97c-0.78-0.779-1.86-1.485-3.24-2.115 c-1.381-0.63-3.015-1.215-4.905-1.755c-1.89-0.54-3.946-1.139-6.165-1.8c-2.94-0.9-5.49-1.875-7.65-2.925 c-2.16-1.049-3.946-2.264-5.355-3.645c-1.41-1.379-2.461-2.97-3.15-4.77c-0.69-1.8-1.035-3.899-1.035-6.3 c0-3.36,0.63-6.33,1.89-8.91c1.26-2.579,2.97-4.754,5.13-6.525c2.16-1.769,4.665-3.105,7.515-4.005 c2.849-0.9,5.864-1.35,9.045-1.35c2.219,0,4.41,0.211,6.57,0.63c2.16,0.42,4.23,0.96,6.21,1.62c1.98,0.661,3.825,1.411,5.535,2.25 c1.71,0.841,3.285,1.68,4.725,2.52l-6.48,12.24c-0.18-0.239-0.81-0.689-1.89-1.35c-1.08-0.66-2.43-1.35-4.05-2.07 c-1.62-0.72-3.391-1.35-5.31-1.89c-1.921-0.54-3.84-0.81-5.76-0.81c-5.281,0-7.92,1.771-7.92,5.31c0,1.08,0.284,1.98,0.855,2.7 c0.57,0.72,1.409,1.366,2.52,1.935c1.11,0.571,2.505,1.095,4.185,1.575c1.679,0.481,3.63,1.021,5.85,1.62 c3.06,0.841,5.819,1.755,8.28,2.745c2.459,0.99,4.545,2.221,6.255,3.69c1.71,1.471,3.029,3.255,3.96,5.355 c0.93,2.101,1.395,4.621,1.395,7.56C163.016,244.15,162.34,247.196,160.991,249.685z M213.955,259.36l-4.95-14.31h-19.89 l-4.86,14.31h-15.12l23.31-63.9h13.32l23.31,63.9H213.955z M285.595,259.36h-45.72v-63.9h14.76v50.94h30.96V259.36z M341.935,259.36h-44.91v-63.9h44.1v12.96h-29.34v12.42h25.2v11.97h-25.2v13.59h30.15V259.36z"></path>
+    </g>
+</g>
+</symbol>
+</svg>"""
+_SALE_SVG = '<svg fill="#d00b0b" stroke="#d00b0b" height="40px" width="40px"><use href="#sale-icon"></use></svg>'
+
+@st.fragment
+def render_results(filtered_data, view_mode):
+    """Render the page selector and the current page of products.
+
+    Runs as a fragment, so changing the page, selecting a table row or opening
+    a card's details reruns only this block, not the sidebar and filter pipeline.
+    """
+    # Pagination
+    page_size = 10
+    total_products = len(filtered_data)
+    total_pages = (total_products // page_size) + (1 if total_products % page_size else 0)
+    if total_pages > 0:
+        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
+    else:
+        page = 1
+    start_idx = (page - 1) * page_size
+    page_data = filtered_data.iloc[start_idx:start_idx + page_size]
+
+    if view_mode == 'Table':
+        # Formatted like the cards: rounded ratings and 'N/A' text, so no column mixes numbers and strings
+        table_data = display_values(page_data[['title', 'raw_ec_price', 'raw_ec_rating', 'raw_avg_reviews']]).astype(str)
+        # Missing images stay empty cells instead of 'N/A' URLs the image column would show as broken
+        table_data.insert(0, 'raw_ec_thumbnails', page_data['raw_ec_thumbnails'].where(page_data['_has_image'], None))
+        # One batched table widget for the page; the full card is only built for the clicked row
+        event = st.dataframe(
+            table_data,
+            column_config={
+                'raw_ec_thumbnails': st.column_config.ImageColumn("Image", width='small'),
+                'title': "Title",
+                'raw_ec_price': "Price",
+                'raw_ec_rating': "Rating",
+                'raw_avg_reviews': "Reviews",
+            },
+            hide_index=True,
+            use_container_width=True,
+            on_select="rerun",
+            selection_mode="single-row",
+        )
+        page_data = page_data.iloc[event.selection.rows]
+
+    # Plain dicts for the page rows: one conversion instead of a Series per iterrows() step.
+    # Values missing after numeric coercion display as 'N/A', as they did before.
+    rows = display_values(page_data[list(DISPLAY_COLS)]).to_dict(orient='records')
+
+    # Display Products
+    for idx, row in enumerate(rows, start=start_idx):
+        # Title and flag markup is cached per (title, country), so revisited cards skip the flag lookup
+        st.markdown(card_header_html(row['title'], row['raw_country_of_manufacture']), unsafe_allow_html=True)
+
+        # Use 'id' if it exists, otherwise fallback to 'title' or generate a unique identifier
+        wine_id = row['uri'] if row['uri'] != 'N/A' else row['title']  # Fallback to 'title' if 'uri' is missing
+        if not wine_id:
+            wine_id = f"wine-{idx}"  # Generate a unique ID if both are missing
+
+        # Favourite button
+        is_favourite = wine_id in st.session_state.get("favourites", set())  # Check the updated favourites list
+        heart_icon = "❤️" if is_favourite else "🤍"
+        # Toggling needs the real favourites list, otherwise an existing favourite would be added again
+        if st.session_state.authorized and "favourites" in st.session_state:
+            if st.button(f"{heart_icon} Favourite", key=f"fav-{wine_id}"):
+                toggle_favourite(wine_id)
+        else:
+            st.markdown(f"{heart_icon} Favourite", unsafe_allow_html=True)
+
+        # Price (sale icon and struck-through regular price when on promo) and rating lines are preformatted at load
+        st.markdown(row['_price_html'], unsafe_allow_html=True)
+        st.markdown(row['_rating_md'])
+
+        # Display the thumbnail image
+        thumbnail_url = row['raw_ec_thumbnails']
+        if row['_has_image']:
+            # Native lazy loading so thumbnails below the fold are fetched and decoded only when scrolled to
+            st.markdown(
+                f'<img src="{html.escape(thumbnail_url)}" width="150" height="150" loading="lazy" '
+                f'decoding="async" style="object-fit: contain;">',
+                unsafe_allow_html=True
+            )
+            # Add an "Enlarge Image" link below the thumbnail; a plain anchor needs no widget or Python work
+            st.markdown(
+                f'<a href="{html.escape(row["_thumb_2048"])}" target="_blank" rel="noopener">Enlarge Image</a>',
+                unsafe_allow_html=True
+            )
+        else:
+            st.write("No image available.")
+
+        # -- Instead of a "View Details" button, use a toggle --
+        # An expander runs its body on every rerun even when collapsed, so the
+        # detail elements are only built for cards whose toggle is switched on
+        if st.toggle("Product Details", key=f"details-{wine_id}"):
+            with st.container(border=True):
+                # Here, just inline the same content you used to show in show_detailed_product_popup()
+                st.write("### Detailed Product View")
+                if row['_has_image']:
+                    detail_image_url = row['_thumb_1280']
+                    st.image(detail_image_url, width=300)
+                # One markdown element for the whole detail list instead of one per field
+                details = ["<p><strong>Vintage</strong></p>"] if row['_is_vintages'] else []
+                details += [
+                    f"<strong>{label}:</strong> {html.escape(str(row[column]))}<br>"
+                    for label, column in DETAIL_FIELDS
+                ]
+                details.append("<hr>")
+                st.markdown("".join(details), unsafe_allow_html=True)
+
 def main():
     st.title("🍷 LCBO Wine Filter")
-    # Add this line to clear the cached data
-    st.cache_data.clear()
+    st.markdown(_SALE_SVG_SYMBOL, unsafe_allow_html=True)
 
     # Sidebar Filters with improved header
     st.sidebar.header("Filter Options 🔍")
@@ -496,11 +989,9 @@ def main():
             else:
                 st.sidebar.error("Incorrect PIN. Please try again.")
 
-    # Initialize session state for favourites and UI updates
+    # Initialize session state for favourites
     if "favourites" not in st.session_state:
-        st.session_state.favourites = load_favourites()
-    if "ui_updated" not in st.session_state:
-        st.session_state.ui_updated = False
+        reload_session_favourites()
 
     # Initialize session state for store and image modal trigger
     if 'selected_store' not in st.session_state:
@@ -524,20 +1015,22 @@ def main():
             store_id = store_ids.get(selected_store)
             data = refresh_data(store_id=store_id)
         else:
-            data = load_products_from_supabase()
+            data = None
     else:
-        data = load_products_from_supabase()
+        data = None
+    if data is None:
+        # No refresh this run, or the refresh could not fetch the catalog
+        data = load_catalog()
 
     search_text = st.sidebar.text_input("Search", value="")
-    sort_by = st.sidebar.selectbox("Sort by", ['Sort by', '# of reviews', 'Rating', 'Top Veiwed - Year', 'Top Veiwed - Month', 'Top Seller - Year', 'Top Seller - Month'])
+    sort_by = st.sidebar.selectbox("Sort by", ['Sort by', '# of reviews', 'Rating', 'Top Viewed - Year', 'Top Viewed - Month', 'Top Seller - Year', 'Top Seller - Month'])
 
     # Create filter options from data
-    food_items = load_food_items()
-    categories = food_items['Category'].unique()
-    country_options = ['All Countries'] + sorted(data['raw_country_of_manufacture'].dropna().unique().tolist())
-    region_options = ['All Regions'] + sorted(data['raw_lcbo_region_name'].dropna().unique().tolist())
-    varietal_options = ['All Varietals'] + sorted(data['raw_lcbo_varietal_name'].dropna().unique().tolist())
-    food_options = ['All Dishes'] + sorted(categories.tolist())
+    filter_options = _filter_options(data_fingerprint(data), data)
+    country_options = filter_options['raw_country_of_manufacture']
+    region_options = filter_options['raw_lcbo_region_name']
+    varietal_options = filter_options['raw_lcbo_varietal_name']
+    food_options = food_category_options()
 
     country = st.sidebar.selectbox("Country", options=country_options)
     region = st.sidebar.selectbox("Region", options=region_options)
@@ -548,10 +1041,14 @@ def main():
     only_vintages = st.sidebar.checkbox("Only Vintages", value=False)
     only_sale_items = st.sidebar.checkbox("Only Sale Items", value=False)
     only_favourites = st.sidebar.checkbox("Only Favourites", value=False)
+    view_mode = st.sidebar.radio("View", ['Cards', 'Table'], horizontal=True)
 
     # Load favourites from session state
-    favourites = st.session_state.favourites
+    favourites = st.session_state.get("favourites", set())
    
+    # Food pairings selected by the "Food Category" filter; the food table is only consulted for a real category
+    food_pattern = food_category_pattern(food_category) if food_category != 'All Dishes' else None
+
     # Apply Filters and Sorting
     filters = {
         'country': country,
@@ -560,148 +1057,18 @@ def main():
         'exclude_usa': exclude_usa,
         'in_stock': in_stock,
         'only_vintages': only_vintages,
+        'only_sale_items': only_sale_items,
+        # A sorted tuple keeps the favourites part of the cache key hashable
+        'favourites': tuple(sorted(favourites)) if only_favourites else None,
+        'food_pattern': food_pattern,
         'store': selected_store,
         'search_text': search_text
     }
-    filtered_data = filter_and_sort_data(data, sort_by, **filters)
-
-    # Apply "Only Sale Items" filter
-    if only_sale_items:
-        filtered_data = filtered_data[filtered_data['raw_ec_promo_price'].notna() & (filtered_data['raw_ec_promo_price'] != 'N/A')]
-
-    # Apply "Only Favourites" filter
-    if only_favourites:
-        filtered_data = filtered_data[filtered_data['uri'].isin(favourites)]
+    filtered_data = _filtered_sorted_data(data_fingerprint(data), tuple(filters.items()), sort_by, data)
 
     st.write(f"Showing **{len(filtered_data)}** products")
              
-    # Pagination
-    page_size = 10
-    total_products = len(filtered_data)
-    total_pages = (total_products // page_size) + (1 if total_products % page_size else 0)
-    if total_pages > 0:
-        page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
-    else:
-        page = 1
-    start_idx = (page - 1) * page_size
-    end_idx = start_idx + page_size
-    page_data = filtered_data.iloc[start_idx:end_idx]
-
-    # Display Products
-    for idx, row in page_data.iterrows():
-        # Get the flag URL
-        country_name = row.get('raw_country_of_manufacture', 'N/A')
-        flag_url = get_country_flag_url(country_name) if country_name != 'N/A' else None
-
-        # Combine the title and flag in a single Markdown string
-        if flag_url:
-            st.markdown(
-                f"""<h3 style="display: flex; align-items: center;">
-                    {row['title']}
-                    <img src="{flag_url}" alt="{country_name}" style="margin-left: 10px; width: 30px; height: 20px;">
-                </h3>""",
-                unsafe_allow_html=True
-            )
-        else:
-            st.markdown(f"### {row['title']}")
-
-        promo_price = row.get('raw_ec_promo_price', None)
-        regular_price = row.get('raw_ec_price', 'N/A')
-
-        # Use 'id' if it exists, otherwise fallback to 'title' or generate a unique identifier
-        wine_id = row.get('uri', row['title'])  # Fallback to 'title' if 'id' is missing
-        if not wine_id:
-            wine_id = f"wine-{idx}"  # Generate a unique ID if both are missing
-
-        # Favourite button
-        is_favourite = wine_id in st.session_state.favourites  # Check the updated favourites list
-        heart_icon = "❤️" if is_favourite else "🤍"
-        if st.session_state.authorized:
-            if st.button(f"{heart_icon} Favourite", key=f"fav-{wine_id}"):
-                toggle_favourite(wine_id)
-        else:
-            st.markdown(f"{heart_icon} Favourite", unsafe_allow_html=True)
-
-        # Raw SVG data for the sale icon
-        sale_icon_svg = """
-        <svg fill="#d00b0b" height="40px" width="40px" version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 455 455" xml:space="preserve" stroke="#d00b0b">
-        <g id="SVGRepo_bgCarrier" stroke-width="0"></g>
-        <g id="SVGRepo_tracerCarrier" stroke-linecap="round" stroke-linejoin="round"></g>
-        <g id="SVGRepo_iconCarrier">
-            <g>
-                <polygon points="191.455,234.88 206.575,234.88 199.105,212.29"></polygon>
-                <path d="M0,113.06V341.94h455V113.06H0z M160.991,249.685c-1.35,2.49-3.136,4.5-5.355,6.03c-2.221,1.53-4.77,2.641-7.65,3.33 c-2.88,0.689-5.85,1.035-8.91,1.035c-2.34,0-4.741-0.18-7.2-0.54c-2.461-0.36-4.86-0.885-7.2-1.575 c-2.34-0.689-4.605-1.515-6.795-2.475c-2.191-0.959-4.216-2.07-6.075-3.33l6.48-12.87c0.239,0.301,1.02,0.87,2.34,1.71 c1.319,0.841,2.955,1.68,4.905,2.52c1.949,0.841,4.125,1.59,6.525,2.25c2.399,0.661,4.829,0.99,7.29,0.99 c5.22,0,7.83-1.589,7.83-4.77c0-1.199-0.391-2.189-1.17-2.97c-0.78-0.779-1.86-1.485-3.24-2.115 c-1.381-0.63-3.015-1.215-4.905-1.755c-1.89-0.54-3.946-1.139-6.165-1.8c-2.94-0.9-5.49-1.875-7.65-2.925 c-2.16-1.049-3.946-2.264-5.355-3.645c-1.41-1.379-2.461-2.97-3.15-4.77c-0.69-1.8-1.035-3.899-1.035-6.3 c0-3.36,0.63-6.33,1.89-8.91c1.26-2.579,2.97-4.754,5.13-6.525c2.16-1.769,4.665-3.105,7.515-4.005 c2.849-0.9,5.864-1.35,9.045-1.35c2.219,0,4.41,0.211,6.57,0.63c2.16,0.42,4.23,0.96,6.21,1.62c1.98,0.661,3.825,1.411,5.535,2.25 c1.71,0.841,3.285,1.68,4.725,2.52l-6.48,12.24c-0.18-0.239-0.81-0.689-1.89-1.35c-1.08-0.66-2.43-1.35-4.05-2.07 c-1.62-0.72-3.391-1.35-5.31-1.89c-1.921-0.54-3.84-0.81-5.76-0.81c-5.281,0-7.92,1.771-7.92,5.31c0,1.08,0.284,1.98,0.855,2.7 c0.57,0.72,1.409,1.366,2.52,1.935c1.11,0.571,2.505,1.095,4.185,1.575c1.679,0.481,3.63,1.021,5.85,1.62 c3.06,0.841,5.819,1.755,8.28,2.745c2.459,0.99,4.545,2.221,6.255,3.69c1.71,1.471,3.029,3.255,3.96,5.355 c0.93,2.101,1.395,4.621,1.395,7.56C163.016,244.15,162.34,247.196,160.991,249.685z M213.955,259.36l-4.95-14.31h-19.89 l-4.86,14.31h-15.12l23.31-63.9h13.32l23.31,63.9H213.955z M285.595,259.36h-45.72v-63.9h14.76v50.94h30.96V259.36z M341.935,259.36h-44.91v-63.9h44.1v12.96h-29.34v12.42h25.2v11.97h-25.2v13.59h30.15V259.36z"></path>
-            </g>
-        </g>
-        </svg>
-        """
-
-        if pd.notna(promo_price) and promo_price != 'N/A':
-            # Display sale price with embedded SVG and strikethrough for regular price
-            st.markdown(
-                f"""<div style="font-size: 16px;"><strong>Price:</strong> <svg fill="#d00b0b" height="40px" width="40px" version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 455 455" xml:space="preserve" stroke="#d00b0b">
-        <g id="SVGRepo_bgCarrier" stroke-width="0"></g>
-        <g id="SVGRepo_tracerCarrier" stroke-linecap="round" stroke-linejoin="round"></g>
-        <g id="SVGRepo_iconCarrier">
-            <g>
-                <polygon points="191.455,234.88 206.575,234.88 199.105,212.29"></polygon>
-                <path d="M0,113.06V341.94h455V113.06H0z M160.991,249.685c-1.35,2.49-3.136,4.5-5.355,6.03c-2.221,1.53-4.77,2.641-7.65,3.33 c-2.88,0.689-5.85,1.035-8.91,1.035c-2.34,0-4.741-0.18-7.2-0.54c-2.461-0.36-4.86-0.885-7.2-1.575 c-2.34-0.689-4.605-1.515-6.795-2.475c-2.191-0.959-4.216-2.07-6.075-3.33l6.48-12.87c0.239,0.301,1.02,0.87,2.34,1.71 c1.319,0.841,2.955,1.68,4.905,2.52c1.949,0.841,4.125,1.59,6.525,2.25c2.399,0.661,4.829,0.99,7.29,0.99 c5.22,0,7.83-1.589,7.83-4.77c0-1.199-0.391-2.189-1.17-2.97c-0.78-0.779-1.86-1.485-3.24-2.115 c-1.381-0.63-3.015-1.215-4.905-1.755c-1.89-0.54-3.946-1.139-6.165-1.8c-2.94-0.9-5.49-1.875-7.65-2.925 c-2.16-1.049-3.946-2.264-5.355-3.645c-1.41-1.379-2.461-2.97-3.15-4.77c-0.69-1.8-1.035-3.899-1.035-6.3 c0-3.36,0.63-6.33,1.89-8.91c1.26-2.579,2.97-4.754,5.13-6.525c2.16-1.769,4.665-3.105,7.515-4.005 c2.849-0.9,5.864-1.35,9.045-1.35c2.219,0,4.41,0.211,6.57,0.63c2.16,0.42,4.23,0.96,6.21,1.62c1.98,0.661,3.825,1.411,5.535,2.25 c1.71,0.841,3.285,1.68,4.725,2.52l-6.48,12.24c-0.18-0.239-0.81-0.689-1.89-1.35c-1.08-0.66-2.43-1.35-4.05-2.07 c-1.62-0.72-3.391-1.35-5.31-1.89c-1.921-0.54-3.84-0.81-5.76-0.81c-5.281,0-7.92,1.771-7.92,5.31c0,1.08,0.284,1.98,0.855,2.7 c0.57,0.72,1.409,1.366,2.52,1.935c1.11,0.571,2.505,1.095,4.185,1.575c1.679,0.481,3.63,1.021,5.85,1.62 c3.06,0.841,5.819,1.755,8.28,2.745c2.459,0.99,4.545,2.221,6.255,3.69c1.71,1.471,3.029,3.255,3.96,5.355 c0.93,2.101,1.395,4.621,1.395,7.56C163.016,244.15,162.34,247.196,160.991,249.685z M213.955,259.36l-4.95-14.31h-19.89 l-4.86,14.31h-15.12l23.31-63.9h13.32l23.31,63.9H213.955z M285.595,259.36h-45.72v-63.9h14.76v50.94h30.96V259.36z M341.935,259.36h-44.91v-63.9h44.1v12.96h-29.34v12.42h25.2v11.97h-25.2v13.59h30.15V259.36z"></path>
-            </g>
-        </g>
-        </svg>
-                <strong>${promo_price}</strong> <span style="text-decoration: line-through; color: gray;">${regular_price}</span></div>""",
-                unsafe_allow_html=True
-            )
-        else:
-            # Display only the regular price
-            st.markdown(
-                f"""<div style="font-size: 16px;"><strong>Price:</strong> ${regular_price}</div>""",
-                unsafe_allow_html=True
-            )
-
-        st.markdown(f"**Rating:** {row.get('raw_ec_rating', 'N/A')} | **Reviews:** {row.get('raw_avg_reviews', 'N/A')}")
-
-        # Display the thumbnail image
-        thumbnail_url = row.get('raw_ec_thumbnails', None)
-        if pd.notna(thumbnail_url) and thumbnail_url != 'N/A':
-            st.image(thumbnail_url, width=150)
-            # Add an "Enlarge Image" button below the thumbnail.
-            with st.popover("Enlarge Image"):
-                large_image_url = transform_image_url(thumbnail_url, "2048.2048.png")
-                st.image(large_image_url, use_container_width=True)
-        else:
-            st.write("No image available.")
-
-        # -- Instead of a "View Details" button, use an expander --
-        with st.expander("Product Details", expanded=False):
-            # Here, just inline the same content you used to show in show_detailed_product_popup()
-            st.write("### Detailed Product View")
-            if pd.notna(thumbnail_url) and thumbnail_url != 'N/A':
-                detail_image_url = transform_image_url(thumbnail_url, "1280.1280.png")
-                st.image(detail_image_url, width=300)
-            if pd.notna(row['raw_lcbo_program']) and row['raw_lcbo_program'] != 'N/A': 
-                st.markdown(f"**Vintage**")
-            st.markdown(f"**Title:** {row['title']}")
-            st.markdown(f"**URL:** {row['uri']}")
-            st.markdown(f"**Country:** {row['raw_country_of_manufacture']}")
-            st.markdown(f"**Region:** {row['raw_lcbo_region_name']}")
-            st.markdown(f"**Type:** {row['raw_lcbo_varietal_name']}")
-            st.markdown(f"**Size:** {row['raw_lcbo_unit_volume']}")
-            st.markdown(f"**Description:** {row['raw_ec_shortdesc']}")
-            st.markdown(f"**Price:** {row['raw_ec_price']}")
-            st.markdown(f"**Rating:** {row['raw_ec_rating']}")
-            st.markdown(f"**Reviews:** {row['raw_avg_reviews']}")
-            st.markdown(f"**Store Inventory:** {row['stores_inventory']}")
-            st.markdown(f"**Monthly Sold Rank:** {row['raw_sell_rank_monthly']}")
-            st.markdown(f"**Monthly View Rank:** {row['raw_view_rank_monthly']}")
-            st.markdown(f"**Yearly Sold Rank:** {row['raw_sell_rank_yearly']}")
-            st.markdown(f"**Yearly View Rank:** {row['raw_view_rank_yearly']}")
-            st.markdown(f"**Alcohol %:** {row['raw_lcbo_alcohol_percent']}")
-            st.markdown(f"**Sugar (p/ltr):** {row['raw_lcbo_sugar_gm_per_ltr']}")
-            st.markdown("---")
-
-    # Reset the UI update flag
-    st.session_state.ui_updated = False
+    render_results(filtered_data, view_mode)
 
 if __name__ == "__main__":
     main()
@@ -17,29 +17,30 @@ def display_favorites(favorites):
     return [products[wine_id] for wine_id in favorites if wine_id in products]
 
 def load_favorites():
-    """Load favorites from KVStore."""
+    """Load favorites from KVStore as an insertion-ordered dict, for O(1) membership checks."""
     headers = {"Authorization": f"Bearer {API_KEY}"}
     response = requests.get(KVSTORE_URL, headers=headers)
     if response.status_code == 200:
-        return response.json()
-    return []
+        # Dict keys keep the stored order, unlike a set
+        return dict.fromkeys(response.json())
+    return {}
 
 def save_favorites(favorites):
     """Save favorites to KVStore."""
     headers = {"Authorization": f"Bearer {API_KEY}"}
-    response = requests.put(KVSTORE_URL, json=favorites, headers=headers)
+    response = requests.put(KVSTORE_URL, json=list(favorites), headers=headers)
     response.raise_for_status()
 
 def add_favorite(wine_id, favorites):
     """Add a wine to the favorites list."""
     if wine_id not in favorites:
-        favorites.append(wine_id)
+        favorites[wine_id] = None
         save_favorites(favorites)
 
 def remove_favorite(wine_id, favorites):
     """Remove a wine from the favorites list."""
     if wine_id in favorites:
-        favorites.remove(wine_id)
+        del favorites[wine_id]
         save_favorites(favorites)
 
 def is_favorite(wine_id, favorites):
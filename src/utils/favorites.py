@@ -1,36 +1,92 @@
+import json
+import os
+import threading
+
+FAVOURITES_PATH = "data/favourites.json"
+FAVOURITES_LOG_PATH = "data/favourites.log"
+
+# In-memory favourites and the number of entries in the change log since the last compaction
+_favourites = None
+_log_entries = 0
+# Streamlit runs each session on its own thread, and they all share this module's state
+_lock = threading.RLock()
+
+def _append_log(op, wine_id):
+    """Record a single '+id' / '-id' change instead of rewriting the whole file."""
+    global _log_entries
+    with _lock:
+        with open(FAVOURITES_LOG_PATH, "a") as f:
+            f.write(f"{op}{wine_id}\n")
+        _log_entries += 1
+        if _log_entries > 2 * max(len(_favourites), 1):
+            save_favourites(_favourites)
+
 def load_favourites():
-    """Load favourites from the JSON file."""
-    try:
-        with open("data/favourites.json", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+    """Load favourites from the JSON snapshot, replaying and compacting the change log."""
+    global _favourites
+    with _lock:
+        if _favourites is None:
+            try:
+                with open(FAVOURITES_PATH, "r") as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                snapshot = []
+            if isinstance(snapshot, dict):
+                snapshot = snapshot.get("favorites", [])
+            favourites = set(snapshot)
+            try:
+                with open(FAVOURITES_LOG_PATH, "r") as f:
+                    changes = f.read().splitlines()
+            except FileNotFoundError:
+                changes = []
+            for line in changes:
+                op, wine_id = line[:1], line[1:]
+                if op == "+":
+                    favourites.add(wine_id)
+                elif op == "-":
+                    favourites.discard(wine_id)
+            _favourites = favourites
+            # Only compact when there were changes to fold in, so an unchanged snapshot is left as is
+            if changes:
+                save_favourites(_favourites)
+        return _favourites
 
 def save_favourites(favourites):
-    """Save favourites to the JSON file."""
-    with open("data/favourites.json", "w") as f:
-        json.dump(favourites, f)
+    """Compact favourites into the JSON file and truncate the change log."""
+    global _favourites, _log_entries
+    with _lock:
+        _favourites = favourites if isinstance(favourites, set) else set(favourites)
+        # Written aside and swapped in, so a crash mid-write never leaves a truncated snapshot
+        tmp_path = f"{FAVOURITES_PATH}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"favorites": sorted(_favourites)}, f, indent=4)
+        os.replace(tmp_path, FAVOURITES_PATH)
+        # The log is only cleared once the snapshot holding its changes is in place
+        open(FAVOURITES_LOG_PATH, "w").close()
+        _log_entries = 0
 
 def add_favourite(wine_id, pin, correct_pin):
     """Add a wine to favourites if the correct PIN is provided."""
     if pin == correct_pin:
-        favourites = load_favourites()
-        if wine_id not in favourites:
-            favourites.append(wine_id)
-            save_favourites(favourites)
-            return True
+        with _lock:
+            favourites = load_favourites()
+            if wine_id not in favourites:
+                favourites.add(wine_id)
+                _append_log("+", wine_id)
+                return True
     return False
 
 def remove_favourite(wine_id, pin, correct_pin):
     """Remove a wine from favourites if the correct PIN is provided."""
     if pin == correct_pin:
-        favourites = load_favourites()
-        if wine_id in favourites:
-            favourites.remove(wine_id)
-            save_favourites(favourites)
-            return True
+        with _lock:
+            favourites = load_favourites()
+            if wine_id in favourites:
+                favourites.discard(wine_id)
+                _append_log("-", wine_id)
+                return True
     return False
 
 def get_favourites():
     """Retrieve the list of favourite wines."""
-    return load_favourites()
\ No newline at end of file
+    return load_favourites()